@@ -1,74 +1,245 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import folium
-from streamlit_folium import folium_static
 import math
 import os
+import tempfile
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # Sin scipy se recorre toda la tabla con distancias_desde
+    cKDTree = None
+
+# Latitud y longitud separadas por coma (-13.26,-64.05) o, sin coma,
+# por el signo negativo de la longitud (-13.26-64.05, 13.26-64.05)
+PATRON_GEO = r'^(-?\d+(?:\.\d+)?)(?:,(-?\d+(?:\.\d+)?)|(-\d+(?:\.\d+)?))$'
 
 def limpiar_coordenadas(geo):
     """
-    Limpia la coordenada GEO eliminando espacios
-    Convierte a formato flotante
-    Maneja diferentes formatos: con coma, sin coma, con espacios
+    Limpia la columna GEO eliminando espacios
+    Separa latitud y longitud en dos columnas flotantes ('lat', 'lon')
+    Las coordenadas inválidas quedan como NaN
+    """
+    geo_str = geo.astype(str).str.replace(' ', '', regex=False)
+    partes = geo_str.str.extract(PATRON_GEO)
+    coords = pd.DataFrame({
+        'lat': partes[0],
+        'lon': partes[1].fillna(partes[2]),
+    })
+    return coords.astype(np.float64)
+
+RADIO_TIERRA_KM = 6371.0  # Radio de la Tierra en km
+KM_POR_GRADO = math.pi * RADIO_TIERRA_KM / 180
+
+def calcular_distancia(lat_r, lon_r, cos_lat_r, lat0, lon0):
+    """
+    Calcular distancia en kilómetros desde un punto objetivo
+    Fórmula de haversine vectorizada sobre latitudes y longitudes en radianes,
+    con el coseno de la latitud ya precalculado
+    """
+    lat0_r = math.radians(lat0)
+    lon0_r = math.radians(lon0)
+    dlat = lat_r - lat0_r
+    dlon = lon_r - lon0_r
+    a = (np.sin(dlat * 0.5)**2 +
+         math.cos(lat0_r) * cos_lat_r * np.sin(dlon * 0.5)**2)
+    return 2 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(a))
+
+def load_source(ruta_excel):
+    """
+    Leer los datos desde una copia Parquet junto al archivo Excel
+    La copia se regenera cuando el Excel es más reciente
+    Si no se puede escribir o leer la copia, se usa el Excel directamente
     """
+    ruta_parquet = os.path.splitext(ruta_excel)[0] + '.parquet'
+    if (os.path.exists(ruta_parquet) and
+            os.path.getmtime(ruta_parquet) >= os.path.getmtime(ruta_excel)):
+        try:
+            return pd.read_parquet(ruta_parquet, engine='pyarrow', dtype_backend='pyarrow')
+        except Exception:
+            pass
+    
+    # Columnas de texto como cadenas Arrow en lugar de objetos de Python
+    df = pd.read_excel(ruta_excel).convert_dtypes(dtype_backend='pyarrow')
+    
+    # Escribir en un archivo temporal y reemplazar de forma atómica, para no
+    # dejar una copia truncada si se interrumpe o si dos sesiones escriben a la vez
     try:
-        geo_str = str(geo).replace(' ', '')
-        
-        # Verificar si tiene coma
-        if ',' in geo_str:
-            coords = geo_str.split(',')
+        fd, ruta_tmp = tempfile.mkstemp(
+            suffix='.parquet.tmp', dir=os.path.dirname(os.path.abspath(ruta_parquet))
+        )
+        os.close(fd)
+    except OSError:
+        return df
+    try:
+        df.to_parquet(ruta_tmp, engine='pyarrow', compression='zstd')
+        os.replace(ruta_tmp, ruta_parquet)
+    except Exception:
+        if os.path.exists(ruta_tmp):
+            os.remove(ruta_tmp)
+    return df
+
+def indices_cercanos(distancias, k=5):
+    """
+    Posiciones de las k distancias menores, ordenadas de menor a mayor
+    Usa selección parcial (argpartition) en lugar de ordenar todo el arreglo
+    """
+    d = np.asarray(distancias, dtype=np.float64)
+    validos = np.flatnonzero(~np.isnan(d))
+    k = min(k, validos.size)
+    if k == 0:
+        return validos
+    d_validos = d[validos]
+    parte = np.argpartition(d_validos, k - 1)[:k]
+    return validos[parte[np.argsort(d_validos[parte])]]
+
+@st.cache_data(show_spinner=False)
+def load_geos(ruta_archivo, mtime):
+    """
+    Leer el archivo de rutas y limpiar coordenadas GEO
+    Se cachea por ruta y fecha de modificación del archivo
+    Retorna el DataFrame con coordenadas válidas y el número de filas descartadas
+    """
+    df = load_source(ruta_archivo)
+    
+    # Limpiar coordenadas GEO en columnas 'lat' y 'lon'
+    df[['lat', 'lon']] = limpiar_coordenadas(df['GEO'])
+    
+    # Eliminar filas con coordenadas inválidas
+    validas = df[['lat', 'lon']].notna().all(axis=1)
+    df = df[validas].copy()
+    
+    # Radianes y coseno de la latitud para el recorrido sin scipy (distancias_desde).
+    # En float32 ese recorrido lee la mitad de memoria; el error (< 1 m) puede
+    # cambiar el orden entre rutas casi coincidentes. 'lat'/'lon' siguen en
+    # float64 para el árbol KD, que no usa estas columnas
+    lat_r = np.radians(df['lat'].to_numpy())
+    df['lat_r'] = lat_r.astype(np.float32)
+    df['lon_r'] = np.radians(df['lon'].to_numpy()).astype(np.float32)
+    df['cos_lat_r'] = np.cos(lat_r).astype(np.float32)
+    return df, int((~validas).sum())
+
+def distancias_desde(ruta_archivo, mtime, lat0, lon0, k=5):
+    """
+    Calcular distancias en km desde el punto objetivo
+    Solo calcula haversine dentro de una caja de grados alrededor del punto,
+    duplicándola hasta asegurar los k más cercanos; el resto queda como NaN
+    """
+    df, _ = load_geos(ruta_archivo, mtime)
+    lat = df['lat'].to_numpy()
+    lon = df['lon'].to_numpy()
+    lat_r = df['lat_r'].to_numpy()
+    lon_r = df['lon_r'].to_numpy()
+    cos_lat_r = df['cos_lat_r'].to_numpy()
+    
+    # Diferencia de longitud normalizada a [-180, 180) para cruzar el antimeridiano
+    dlon = np.abs((lon - lon0 + 180) % 360 - 180)
+    
+    grados = 0.5
+    while grados < 90:
+        # Semiancho en longitud que garantiza más de `grados` de arco fuera de la caja,
+        # según la latitud más alejada del ecuador dentro de ella
+        cos_lat = math.cos(math.radians(abs(lat0) + grados))
+        seno = math.sin(math.radians(grados) / 2)
+        if abs(lat0) + grados >= 90 or seno >= cos_lat:
+            # La caja alcanza un polo: cualquier longitud puede estar cerca
+            caja = np.abs(lat - lat0) < grados
         else:
-            # Si no tiene coma, buscar donde termina el primer número negativo
-            # Formato: -13.262719-64.052359
-            if geo_str.startswith('-'):
-                # Encontrar el segundo signo menos
-                segundo_menos = geo_str.find('-', 1)
-                if segundo_menos != -1:
-                    coords = [geo_str[:segundo_menos], geo_str[segundo_menos:]]
-                else:
-                    # Formato positivo-negativo: 13.262719-64.052359
-                    menos_pos = geo_str.find('-')
-                    if menos_pos != -1:
-                        coords = [geo_str[:menos_pos], geo_str[menos_pos:]]
-                    else:
-                        # No hay separador claro
-                        return None
-            else:
-                # Formato positivo-negativo
-                menos_pos = geo_str.find('-')
-                if menos_pos != -1:
-                    coords = [geo_str[:menos_pos], geo_str[menos_pos:]]
-                else:
-                    # Buscar punto decimal para dividir (asumiendo formato sin separador)
-                    # Este es un caso más complejo, mejor retornar None
-                    return None
-        
-        return [float(coords[0]), float(coords[1])]
-    except Exception as e:
-        st.error(f"Error limpiando coordenada {geo}: {e}")
-        return None
+            ancho = math.degrees(2 * math.asin(seno / cos_lat))
+            caja = (np.abs(lat - lat0) < grados) & (dlon < ancho)
+        if np.count_nonzero(caja) >= k:
+            d = calcular_distancia(lat_r[caja], lon_r[caja], cos_lat_r[caja], lat0, lon0)
+            # Todo punto fuera de la caja está a más de `grados` * KM_POR_GRADO km
+            if np.partition(d, k - 1)[k - 1] <= grados * KM_POR_GRADO:
+                distancias = np.full(lat.shape, np.nan, dtype=d.dtype)
+                distancias[caja] = d
+                return distancias
+        grados *= 2
+    
+    return calcular_distancia(lat_r, lon_r, cos_lat_r, lat0, lon0)
 
-def calcular_distancia(coord1, coord2):
-    """Calcular distancia en kilómetros entre dos coordenadas"""
-    try:
-        # Desempaquetar coordenadas
-        lat1, lon1 = coord1
-        lat2, lon2 = coord2
-        
-        # Fórmula de haversine
-        R = 6371  # Radio de la Tierra en km
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
-        a = (math.sin(dlat/2)**2 + 
-             math.cos(math.radians(lat1)) * 
-             math.cos(math.radians(lat2)) * 
-             math.sin(dlon/2)**2)
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        return R * c
-    except Exception as e:
-        st.error(f"Error en cálculo de distancia: {e}")
-        return np.nan
+def vector_unitario(lat, lon):
+    """Proyectar coordenadas en grados a vectores (x, y, z) sobre la esfera unitaria"""
+    lat_r = np.radians(lat)
+    lon_r = np.radians(lon)
+    cos_lat = np.cos(lat_r)
+    return np.stack([cos_lat * np.cos(lon_r), cos_lat * np.sin(lon_r), np.sin(lat_r)], axis=-1)
+
+@st.cache_resource(show_spinner=False)
+def build_tree(ruta_archivo, mtime):
+    """Árbol KD sobre las rutas proyectadas a la esfera, construido una vez por archivo"""
+    df, _ = load_geos(ruta_archivo, mtime)
+    return cKDTree(vector_unitario(df['lat'].to_numpy(), df['lon'].to_numpy()))
+
+@st.cache_data(show_spinner=False)
+def rutas_cercanas(ruta_archivo, mtime, lat0, lon0, k=5):
+    """
+    Posiciones y distancias en km de las k rutas más cercanas al punto objetivo
+    Usa el árbol KD si scipy está disponible; si no, recorre toda la tabla
+    """
+    if cKDTree is None:
+        distancias = distancias_desde(ruta_archivo, mtime, lat0, lon0, k)
+        indices = indices_cercanos(distancias, k)
+        return indices, distancias[indices]
+    
+    arbol = build_tree(ruta_archivo, mtime)
+    k = min(k, arbol.n)
+    if k == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0)
+    cuerda, indices = arbol.query(vector_unitario(lat0, lon0), k=k)
+    # Distancia de cuerda en la esfera unitaria -> distancia de haversine
+    cuerda = np.minimum(np.atleast_1d(cuerda), 2.0)
+    return np.atleast_1d(indices), 2 * RADIO_TIERRA_KM * np.arcsin(cuerda / 2)
+
+# Colores de los markers de las rutas cercanas, en orden de distancia
+COLORES = ['blue', 'green', 'purple', 'orange', 'darkred']
+
+def crear_mapa(punto_objetivo, cercanos):
+    """Crear mapa con el punto objetivo (rojo) y las rutas cercanas"""
+    import folium  # Importación diferida: solo se carga al dibujar el mapa
+    
+    m = folium.Map(location=punto_objetivo, zoom_start=10, prefer_canvas=True)
+    
+    # Marker para punto objetivo (rojo)
+    folium.CircleMarker(
+        location=punto_objetivo,
+        radius=10,
+        popup="📍 Punto de Referencia",
+        color='red',
+        fill=True,
+        fillColor='red',
+        fillOpacity=0.7
+    ).add_to(m)
+    
+    # Agregar markers para las rutas cercanas
+    colores = [COLORES[i % len(COLORES)] for i in range(len(cercanos))]
+    
+    # Texto de los popups armado por columnas en lugar de fila por fila
+    def texto(columna):
+        return cercanos[columna].astype(str).fillna('')
+    
+    popups = (
+        '<b>' + texto('Nombre de Ruta') + '</b><br>'
+        + 'Vendedor: ' + texto('Nombre Vendedor') + '<br>'
+        + 'Supervisor: ' + texto('Supervisor') + '<br>'
+        + 'Distancia: ' + np.char.mod('%.2f', cercanos['Distancia'].to_numpy()) + ' km<br>'
+        + 'Status: ' + texto('Status SN') + '<br>'
+        + 'Días: ' + texto('Dias visita')
+    ).to_numpy()
+    
+    filas = zip(colores, popups, cercanos['lat'].to_numpy(), cercanos['lon'].to_numpy())
+    for color, popup_text, lat, lon in filas:
+        folium.CircleMarker(
+            location=[float(lat), float(lon)],
+            radius=8,
+            popup=folium.Popup(popup_text, max_width=300),
+            color=color,
+            fill=True,
+            fillColor=color,
+            fillOpacity=0.6
+        ).add_to(m)
+    
+    return m
 
 def main():
     st.title('🗺️ Buscador de Rutas Cercanas')
@@ -78,14 +249,11 @@ def main():
     ruta_archivo = 'GEOS.xlsx'
     
     try:
-        # Leer el archivo
-        df = pd.read_excel(ruta_archivo)
-        
-        # Limpiar coordenadas GEO
-        df['Coordenadas_Limpias'] = df['GEO'].apply(limpiar_coordenadas)
-        
-        # Eliminar filas con coordenadas inválidas
-        df = df.dropna(subset=['Coordenadas_Limpias'])
+        # Leer el archivo (cacheado entre reruns mientras no cambie)
+        mtime = os.path.getmtime(ruta_archivo)
+        df, descartadas = load_geos(ruta_archivo, mtime)
+        if descartadas:
+            st.warning(f"⚠️ {descartadas} filas descartadas por coordenadas inválidas")
         
         # Columnas para mostrar
         columnas_mostrar = [
@@ -95,66 +263,28 @@ def main():
         # Input de coordenadas
         col1, col2 = st.columns(2)
         with col1:
-            latitud = st.text_input('Latitud', '-17.7830659')
+            lat0 = st.number_input('Latitud', min_value=-90.0, max_value=90.0,
+                                   value=-17.7830659, format="%.7f")
         with col2:
-            longitud = st.text_input('Longitud', '-63.1822989')
+            lon0 = st.number_input('Longitud', min_value=-180.0, max_value=180.0,
+                                   value=-63.1822989, format="%.7f")
         
         # Coordenada objetivo
-        punto_objetivo = [float(latitud), float(longitud)]
+        punto_objetivo = (lat0, lon0)
         
-        # Calcular distancias
-        df['Distancia'] = df['Coordenadas_Limpias'].apply(
-            lambda x: calcular_distancia(punto_objetivo, x) if x is not None else np.nan
-        )
-        
-        # Ordenar por distancia y mostrar los 5 más cercanos
-        cercanos = df.dropna(subset=['Distancia']).sort_values('Distancia').head(5)
+        # Buscar las 5 rutas más cercanas
+        indices, distancias = rutas_cercanas(ruta_archivo, mtime, *punto_objetivo, k=5)
+        cercanos = df.iloc[indices].assign(Distancia=distancias)
         
         # Mostrar resultados
         st.subheader("🎯 5 Rutas Más Cercanas")
         st.dataframe(cercanos[columnas_mostrar + ['Distancia']])
         
-        # Crear mapa
-        m = folium.Map(location=[float(latitud), float(longitud)], zoom_start=10)
-        
-        # Marker para punto objetivo (rojo)
-        folium.CircleMarker(
-            location=[float(latitud), float(longitud)],
-            radius=10,
-            popup="📍 Punto de Referencia",
-            color='red',
-            fill=True,
-            fillColor='red',
-            fillOpacity=0.7
-        ).add_to(m)
-        
-        # Agregar markers para las rutas cercanas
-        colors = ['blue', 'green', 'purple', 'orange', 'darkred']
-        for i, (_, row) in enumerate(cercanos.iterrows()):
-            if row['Coordenadas_Limpias'] is not None:
-                lat, lon = row['Coordenadas_Limpias']
-                popup_text = f"""
-                <b>{row['Nombre de Ruta']}</b><br>
-                Vendedor: {row['Nombre Vendedor']}<br>
-                Supervisor: {row['Supervisor']}<br>
-                Distancia: {row['Distancia']:.2f} km<br>
-                Status: {row['Status SN']}<br>
-                Días: {row['Dias visita']}
-                """
-                
-                folium.CircleMarker(
-                    location=[lat, lon],
-                    radius=8,
-                    popup=folium.Popup(popup_text, max_width=300),
-                    color=colors[i % len(colors)],
-                    fill=True,
-                    fillColor=colors[i % len(colors)],
-                    fillOpacity=0.6
-                ).add_to(m)
-        
         # Mostrar mapa
         st.subheader("🗺️ Mapa de Ubicaciones")
-        folium_static(m)
+        with st.spinner('Cargando mapa...'):
+            from streamlit_folium import st_folium
+            st_folium(crear_mapa(punto_objetivo, cercanos), returned_objects=[])
         
         # Estadísticas adicionales
         st.subheader("📊 Estadísticas")